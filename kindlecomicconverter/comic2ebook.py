@@ -21,25 +21,33 @@
 import os
 import sys
 import argparse
+from errno import EXDEV
 from time import strftime, gmtime
 from copy import copy
+from functools import lru_cache
+from itertools import count
 from glob import glob, escape
-from re import compile, sub
+from re import compile
 from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 from tempfile import mkdtemp, gettempdir, TemporaryFile
-from shutil import move, rmtree, copyfile
+from shutil import move, rmtree, copyfile, which
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from slugify import slugify as slugifyExt
 from PIL import Image, ImageColor
-from subprocess import STDOUT, PIPE
-from psutil import Popen, virtual_memory
+from subprocess import STDOUT, PIPE, DEVNULL
+from psutil import Popen, TimeoutExpired, virtual_memory
 from html import escape as hescape
 try:
     from PyQt5 import QtCore
 except ImportError:
     QtCore = None
-from .shared import md5Checksum, getImageFileName, walkSort, walkLevel, sanitizeTrace, \
+try:
+    from deflate import deflate_compress
+except ImportError:
+    deflate_compress = None
+from .shared import getImageFileName, imageExtensions, walkSort, walkSortKey, walkLevel, walkFiles, sanitizeTrace, \
                     getDirectorySize, getWorkFolder
 from . import comic2panel
 from . import image
@@ -48,6 +56,36 @@ from . import metadata
 from . import kindle
 from . import __version__
 
+slugifyDirPattern = compile(r'[^-a-z0-9_\.]+')
+slugifyNumberPattern = compile(r'([0-9]+)')
+slugifyPaddingPattern = compile(r'0*([0-9]{4,})')
+bordersColorPattern = compile(r"^#?([0-9a-f]{3}){1,2}$")
+# (noHorizontalPV, noVerticalPV, rotatedPage, righttoleft): (boxes, order)
+panelViewLayouts = {(False, False, True, True): (("PV-TL", "PV-TR", "PV-BL", "PV-BR"), (1, 3, 2, 4)),
+                    (False, False, True, False): (("PV-TL", "PV-TR", "PV-BL", "PV-BR"), (2, 4, 1, 3)),
+                    (False, False, False, True): (("PV-TL", "PV-TR", "PV-BL", "PV-BR"), (2, 1, 4, 3)),
+                    (False, False, False, False): (("PV-TL", "PV-TR", "PV-BL", "PV-BR"), (1, 2, 3, 4)),
+                    (True, False, True, True): (("PV-T", "PV-B"), (1, 2)),
+                    (True, False, True, False): (("PV-T", "PV-B"), (2, 1)),
+                    (True, False, False, True): (("PV-T", "PV-B"), (1, 2)),
+                    (True, False, False, False): (("PV-T", "PV-B"), (1, 2)),
+                    (False, True, True, True): (("PV-L", "PV-R"), (1, 2)),
+                    (False, True, True, False): (("PV-L", "PV-R"), (1, 2)),
+                    (False, True, False, True): (("PV-L", "PV-R"), (2, 1)),
+                    (False, True, False, False): (("PV-L", "PV-R"), (1, 2)),
+                    (True, True, True, True): ((), ()),
+                    (True, True, True, False): ((), ()),
+                    (True, True, False, True): ((), ()),
+                    (True, True, False, False): ((), ())}
+panelViewStyles = {"PV-TL": lambda x, y: "position:absolute;left:0;top:0;",
+                   "PV-TR": lambda x, y: "position:absolute;right:0;top:0;",
+                   "PV-BL": lambda x, y: "position:absolute;left:0;bottom:0;",
+                   "PV-BR": lambda x, y: "position:absolute;right:0;bottom:0;",
+                   "PV-T": lambda x, y: "position:absolute;top:0;left:" + x + "%;",
+                   "PV-B": lambda x, y: "position:absolute;bottom:0;left:" + x + "%;",
+                   "PV-L": lambda x, y: "position:absolute;left:0;top:" + y + "%;",
+                   "PV-R": lambda x, y: "position:absolute;right:0;top:" + y + "%;"}
+
 
 def main(argv=None):
     global options, alreadyexistslist, alreadyprocessedlist, copyprocessedlist, multiprocessedlist, completedlist
@@ -119,50 +157,53 @@ def main(argv=None):
     return 0
 
 
-def buildHTML(path, imgfile, imgfilepath):
-    imgfilepath = md5Checksum(imgfilepath)
+def setWorkerOptions(opt):
+    global options
+    options = opt
+
+
+def writeUTF8(path, parts):
+    with open(path, 'wb') as f:
+        f.write(''.join(parts).encode('UTF-8'))
+
+
+def buildHTML(path, imgfile, imgfilepath, imagesroot):
     filename = getImageFileName(imgfile)
     deviceres = options.profileData[1]
-    if "Rotated" in options.imgMetadata[imgfilepath]:
-        rotatedPage = True
-    else:
-        rotatedPage = False
-    if "BlackBackground" in options.imgMetadata[imgfilepath]:
+    flags = options.imgMetadata[imgfilepath]
+    rotatedPage = "Rotated" in flags
+    if "BlackBackground" in flags:
         additionalStyle = 'background-color:#000000;'
     else:
         additionalStyle = ''
-    postfix = ''
-    backref = 1
-    head = path
-    while True:
-        head, tail = os.path.split(head)
-        if tail == 'Images':
-            htmlpath = os.path.join(head, 'Text', postfix)
-            break
-        postfix = tail + "/" + postfix
-        backref += 1
-    if not os.path.exists(htmlpath):
-        os.makedirs(htmlpath)
+    postfix = os.path.relpath(path, imagesroot)
+    if postfix == '.':
+        postfix = ''
+        backref = 1
+    else:
+        backref = postfix.count(os.path.sep) + 2
+        postfix = postfix.replace(os.path.sep, '/') + '/'
+    htmlpath = os.path.join(os.path.dirname(imagesroot), 'Text', postfix)
+    os.makedirs(htmlpath, exist_ok=True)
     htmlfile = os.path.join(htmlpath, filename[0] + '.xhtml')
-    imgsize = Image.open(os.path.join(head, "Images", postfix, imgfile)).size
+    imgsize = options.imgSize[imgfilepath]
     if options.hq:
         imgsizeframe = (int(imgsize[0] // 1.5), int(imgsize[1] // 1.5))
     else:
         imgsizeframe = imgsize
-    f = open(htmlfile, "w", encoding='UTF-8')
-    f.writelines(["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
-                  "<!DOCTYPE html>\n",
-                  "<html xmlns=\"http://www.w3.org/1999/xhtml\" xmlns:epub=\"http://www.idpf.org/2007/ops\">\n",
-                  "<head>\n",
-                  "<title>", hescape(filename[0]), "</title>\n",
-                  "<link href=\"", "../" * (backref - 1), "style.css\" type=\"text/css\" rel=\"stylesheet\"/>\n",
-                  "<meta name=\"viewport\" "
-                  "content=\"width=" + str(imgsize[0]) + ", height=" + str(imgsize[1]) + "\"/>\n"
-                  "</head>\n",
-                  "<body style=\"" + additionalStyle + "\">\n",
-                  "<div style=\"text-align:center;top:" + getTopMargin(deviceres, imgsizeframe) + "%;\">\n",
-                  "<img width=\"" + str(imgsizeframe[0]) + "\" height=\"" + str(imgsizeframe[1]) + "\" ",
-                  "src=\"", "../" * backref, "Images/", postfix, imgfile, "\"/>\n</div>\n"])
+    html = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
+            "<!DOCTYPE html>\n",
+            "<html xmlns=\"http://www.w3.org/1999/xhtml\" xmlns:epub=\"http://www.idpf.org/2007/ops\">\n",
+            "<head>\n",
+            "<title>", hescape(filename[0]), "</title>\n",
+            "<link href=\"", "../" * (backref - 1), "style.css\" type=\"text/css\" rel=\"stylesheet\"/>\n",
+            "<meta name=\"viewport\" "
+            "content=\"width=" + str(imgsize[0]) + ", height=" + str(imgsize[1]) + "\"/>\n"
+            "</head>\n",
+            "<body style=\"" + additionalStyle + "\">\n",
+            "<div style=\"text-align:center;top:" + getTopMargin(deviceres, imgsizeframe) + "%;\">\n",
+            "<img width=\"" + str(imgsizeframe[0]) + "\" height=\"" + str(imgsizeframe[1]) + "\" ",
+            "src=\"", "../" * backref, "Images/", postfix, imgfile, "\"/>\n</div>\n"]
     if options.iskindle and options.panelview:
         if options.autoscale:
             size = (getPanelViewResolution(imgsize, deviceres))
@@ -180,245 +221,172 @@ def buildHTML(path, imgfile, imgfilepath):
         else:
             noVerticalPV = False
         x, y = getPanelViewSize(deviceres, size)
-        boxStyles = {"PV-TL": "position:absolute;left:0;top:0;",
-                     "PV-TR": "position:absolute;right:0;top:0;",
-                     "PV-BL": "position:absolute;left:0;bottom:0;",
-                     "PV-BR": "position:absolute;right:0;bottom:0;",
-                     "PV-T": "position:absolute;top:0;left:" + x + "%;",
-                     "PV-B": "position:absolute;bottom:0;left:" + x + "%;",
-                     "PV-L": "position:absolute;left:0;top:" + y + "%;",
-                     "PV-R": "position:absolute;right:0;top:" + y + "%;"}
-        f.write("<div id=\"PV\">\n")
-        if not noHorizontalPV and not noVerticalPV:
-            if rotatedPage:
-                if options.righttoleft:
-                    order = [1, 3, 2, 4]
-                else:
-                    order = [2, 4, 1, 3]
-            else:
-                if options.righttoleft:
-                    order = [2, 1, 4, 3]
-                else:
-                    order = [1, 2, 3, 4]
-            boxes = ["PV-TL", "PV-TR", "PV-BL", "PV-BR"]
-        elif noHorizontalPV and not noVerticalPV:
-            if rotatedPage:
-                if options.righttoleft:
-                    order = [1, 2]
-                else:
-                    order = [2, 1]
-            else:
-                order = [1, 2]
-            boxes = ["PV-T", "PV-B"]
-        elif not noHorizontalPV and noVerticalPV:
-            if rotatedPage:
-                order = [1, 2]
-            else:
-                if options.righttoleft:
-                    order = [2, 1]
-                else:
-                    order = [1, 2]
-            boxes = ["PV-L", "PV-R"]
-        else:
-            order = []
-            boxes = []
+        html.append("<div id=\"PV\">\n")
+        boxes, order = panelViewLayouts[(noHorizontalPV, noVerticalPV, rotatedPage, bool(options.righttoleft))]
         for i in range(0, len(boxes)):
-            f.writelines(["<div id=\"" + boxes[i] + "\">\n",
-                          "<a style=\"display:inline-block;width:100%;height:100%;\" class=\"app-amzn-magnify\" "
-                          "data-app-amzn-magnify='{\"targetId\":\"" + boxes[i] +
-                          "-P\", \"ordinal\":" + str(order[i]) + "}'></a>\n",
-                          "</div>\n"])
-        f.write("</div>\n")
+            html.extend(["<div id=\"" + boxes[i] + "\">\n",
+                         "<a style=\"display:inline-block;width:100%;height:100%;\" class=\"app-amzn-magnify\" "
+                         "data-app-amzn-magnify='{\"targetId\":\"" + boxes[i] +
+                         "-P\", \"ordinal\":" + str(order[i]) + "}'></a>\n",
+                         "</div>\n"])
+        html.append("</div>\n")
         for box in boxes:
-            f.writelines(["<div class=\"PV-P\" id=\"" + box + "-P\" style=\"" + additionalStyle + "\">\n",
-                          "<img style=\"" + boxStyles[box] + "\" src=\"", "../" * backref, "Images/", postfix,
-                          imgfile, "\" width=\"" + str(size[0]) + "\" height=\"" + str(size[1]) + "\"/>\n",
-                          "</div>\n"])
-    f.writelines(["</body>\n",
-                  "</html>\n"])
-    f.close()
-    return path, imgfile
+            html.extend(["<div class=\"PV-P\" id=\"" + box + "-P\" style=\"" + additionalStyle + "\">\n",
+                         "<img style=\"" + panelViewStyles[box](x, y) + "\" src=\"", "../" * backref, "Images/",
+                         postfix, imgfile, "\" width=\"" + str(size[0]) + "\" height=\"" + str(size[1]) + "\"/>\n",
+                         "</div>\n"])
+    html.extend(["</body>\n",
+                 "</html>\n"])
+    writeUTF8(htmlfile, html)
+    return path, imgfile, filename
 
 
-def buildNCX(dstdir, title, chapters, chapternames):
+def buildNCX(dstdir, title, chapters):
     ncxfile = os.path.join(dstdir, 'OEBPS', 'toc.ncx')
-    f = open(ncxfile, "w", encoding='UTF-8')
-    f.writelines(["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
-                  "<ncx version=\"2005-1\" xml:lang=\"en-US\" xmlns=\"http://www.daisy.org/z3986/2005/ncx/\">\n",
-                  "<head>\n",
-                  "<meta name=\"dtb:uid\" content=\"urn:uuid:", options.uuid, "\"/>\n",
-                  "<meta name=\"dtb:depth\" content=\"1\"/>\n",
-                  "<meta name=\"dtb:totalPageCount\" content=\"0\"/>\n",
-                  "<meta name=\"dtb:maxPageNumber\" content=\"0\"/>\n",
-                  "<meta name=\"generated\" content=\"true\"/>\n",
-                  "</head>\n",
-                  "<docTitle><text>", hescape(title), "</text></docTitle>\n",
-                  "<navMap>\n"])
-    for chapter in chapters:
-        folder = chapter[0].replace(os.path.join(dstdir, 'OEBPS'), '').lstrip('/').lstrip('\\\\')
-        filename = getImageFileName(os.path.join(folder, chapter[1]))
-        navID = folder.replace('/', '_').replace('\\', '_')
-        if options.chapters:
-            title = chapternames[chapter[1]]
-            navID = filename[0].replace('/', '_').replace('\\', '_')
-        elif os.path.basename(folder) != "Text":
-            title = chapternames[os.path.basename(folder)]
-        f.write("<navPoint id=\"" + navID + "\"><navLabel><text>" +
-                hescape(title) + "</text></navLabel><content src=\"" + filename[0].replace("\\", "/") +
-                ".xhtml\"/></navPoint>\n")
-    f.write("</navMap>\n</ncx>")
-    f.close()
-
-
-def buildNAV(dstdir, title, chapters, chapternames):
+    ncx = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
+           "<ncx version=\"2005-1\" xml:lang=\"en-US\" xmlns=\"http://www.daisy.org/z3986/2005/ncx/\">\n",
+           "<head>\n",
+           "<meta name=\"dtb:uid\" content=\"urn:uuid:", options.uuid, "\"/>\n",
+           "<meta name=\"dtb:depth\" content=\"1\"/>\n",
+           "<meta name=\"dtb:totalPageCount\" content=\"0\"/>\n",
+           "<meta name=\"dtb:maxPageNumber\" content=\"0\"/>\n",
+           "<meta name=\"generated\" content=\"true\"/>\n",
+           "</head>\n",
+           "<docTitle><text>", hescape(title), "</text></docTitle>\n",
+           "<navMap>\n"]
+    for href, navID, chaptertitle in chapters:
+        ncx.append("<navPoint id=\"" + navID + "\"><navLabel><text>" +
+                   chaptertitle + "</text></navLabel><content src=\"" + href + ".xhtml\"/></navPoint>\n")
+    ncx.append("</navMap>\n</ncx>")
+    writeUTF8(ncxfile, ncx)
+
+
+def buildNAV(dstdir, title, chapters):
     navfile = os.path.join(dstdir, 'OEBPS', 'nav.xhtml')
-    f = open(navfile, "w", encoding='UTF-8')
-    f.writelines(["<?xml version=\"1.0\" encoding=\"utf-8\"?>\n",
-                  "<!DOCTYPE html>\n",
-                  "<html xmlns=\"http://www.w3.org/1999/xhtml\" xmlns:epub=\"http://www.idpf.org/2007/ops\">\n",
-                  "<head>\n",
-                  "<title>" + hescape(title) + "</title>\n",
-                  "<meta charset=\"utf-8\"/>\n",
-                  "</head>\n",
-                  "<body>\n",
-                  "<nav xmlns:epub=\"http://www.idpf.org/2007/ops\" epub:type=\"toc\" id=\"toc\">\n",
-                  "<ol>\n"])
-    for chapter in chapters:
-        folder = chapter[0].replace(os.path.join(dstdir, 'OEBPS'), '').lstrip('/').lstrip('\\\\')
-        filename = getImageFileName(os.path.join(folder, chapter[1]))
-        if options.chapters:
-            title = chapternames[chapter[1]]
-        elif os.path.basename(folder) != "Text":
-            title = chapternames[os.path.basename(folder)]
-        f.write("<li><a href=\"" + filename[0].replace("\\", "/") + ".xhtml\">" + hescape(title) + "</a></li>\n")
-    f.writelines(["</ol>\n",
-                  "</nav>\n",
-                  "<nav epub:type=\"page-list\">\n",
-                  "<ol>\n"])
-    for chapter in chapters:
-        folder = chapter[0].replace(os.path.join(dstdir, 'OEBPS'), '').lstrip('/').lstrip('\\\\')
-        filename = getImageFileName(os.path.join(folder, chapter[1]))
-        if options.chapters:
-            title = chapternames[chapter[1]]
-        elif os.path.basename(folder) != "Text":
-            title = chapternames[os.path.basename(folder)]
-        f.write("<li><a href=\"" + filename[0].replace("\\", "/") + ".xhtml\">" + hescape(title) + "</a></li>\n")
-    f.write("</ol>\n</nav>\n</body>\n</html>")
-    f.close()
-
-
-def buildOPF(dstdir, title, filelist, cover=None):
+    nav = ["<?xml version=\"1.0\" encoding=\"utf-8\"?>\n",
+           "<!DOCTYPE html>\n",
+           "<html xmlns=\"http://www.w3.org/1999/xhtml\" xmlns:epub=\"http://www.idpf.org/2007/ops\">\n",
+           "<head>\n",
+           "<title>" + hescape(title) + "</title>\n",
+           "<meta charset=\"utf-8\"/>\n",
+           "</head>\n",
+           "<body>\n",
+           "<nav xmlns:epub=\"http://www.idpf.org/2007/ops\" epub:type=\"toc\" id=\"toc\">\n",
+           "<ol>\n"]
+    navitems = []
+    for href, _, chaptertitle in chapters:
+        navitems.append("<li><a href=\"" + href + ".xhtml\">" + chaptertitle + "</a></li>\n")
+    nav.extend(navitems)
+    nav.extend(["</ol>\n",
+                "</nav>\n",
+                "<nav epub:type=\"page-list\">\n",
+                "<ol>\n"])
+    nav.extend(navitems)
+    nav.append("</ol>\n</nav>\n</body>\n</html>")
+    writeUTF8(navfile, nav)
+
+
+def buildOPF(dstdir, title, manifest, reflist, cover=None):
     opffile = os.path.join(dstdir, 'OEBPS', 'content.opf')
     deviceres = options.profileData[1]
     if options.righttoleft:
         writingmode = "horizontal-rl"
     else:
         writingmode = "horizontal-lr"
-    f = open(opffile, "w", encoding='UTF-8')
-    f.writelines(["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
-                  "<package version=\"3.0\" unique-identifier=\"BookID\" ",
-                  "xmlns=\"http://www.idpf.org/2007/opf\">\n",
-                  "<metadata xmlns:opf=\"http://www.idpf.org/2007/opf\" ",
-                  "xmlns:dc=\"http://purl.org/dc/elements/1.1/\">\n",
-                  "<dc:title>", hescape(title), "</dc:title>\n",
-                  "<dc:language>en-US</dc:language>\n",
-                  "<dc:identifier id=\"BookID\">urn:uuid:", options.uuid, "</dc:identifier>\n",
-                  "<dc:contributor id=\"contributor\">KindleComicConverter-" + __version__ + "</dc:contributor>\n"])
+    opf = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n",
+           "<package version=\"3.0\" unique-identifier=\"BookID\" ",
+           "xmlns=\"http://www.idpf.org/2007/opf\">\n",
+           "<metadata xmlns:opf=\"http://www.idpf.org/2007/opf\" ",
+           "xmlns:dc=\"http://purl.org/dc/elements/1.1/\">\n",
+           "<dc:title>", hescape(title), "</dc:title>\n",
+           "<dc:language>en-US</dc:language>\n",
+           "<dc:identifier id=\"BookID\">urn:uuid:", options.uuid, "</dc:identifier>\n",
+           "<dc:contributor id=\"contributor\">KindleComicConverter-" + __version__ + "</dc:contributor>\n"]
     if len(options.summary) > 0:
-        f.writelines(["<dc:description>", options.summary, "</dc:description>\n"])
+        opf.extend(["<dc:description>", options.summary, "</dc:description>\n"])
     for author in options.authors:
-        f.writelines(["<dc:creator>", author, "</dc:creator>\n"])
-    f.writelines(["<meta property=\"dcterms:modified\">" + strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()) + "</meta>\n",
-                  "<meta name=\"cover\" content=\"cover\"/>\n"])
+        opf.extend(["<dc:creator>", author, "</dc:creator>\n"])
+    opf.extend(["<meta property=\"dcterms:modified\">" + strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()) + "</meta>\n",
+                "<meta name=\"cover\" content=\"cover\"/>\n"])
     if options.iskindle and options.profile != 'Custom':
-        f.writelines(["<meta name=\"fixed-layout\" content=\"true\"/>\n",
-                      "<meta name=\"original-resolution\" content=\"",
-                      str(deviceres[0]) + "x" + str(deviceres[1]) + "\"/>\n",
-                      "<meta name=\"book-type\" content=\"comic\"/>\n",
-                      "<meta name=\"primary-writing-mode\" content=\"" + writingmode + "\"/>\n",
-                      "<meta name=\"zero-gutter\" content=\"true\"/>\n",
-                      "<meta name=\"zero-margin\" content=\"true\"/>\n",
-                      "<meta name=\"ke-border-color\" content=\"#FFFFFF\"/>\n",
-                      "<meta name=\"ke-border-width\" content=\"0\"/>\n"])
+        opf.extend(["<meta name=\"fixed-layout\" content=\"true\"/>\n",
+                    "<meta name=\"original-resolution\" content=\"",
+                    str(deviceres[0]) + "x" + str(deviceres[1]) + "\"/>\n",
+                    "<meta name=\"book-type\" content=\"comic\"/>\n",
+                    "<meta name=\"primary-writing-mode\" content=\"" + writingmode + "\"/>\n",
+                    "<meta name=\"zero-gutter\" content=\"true\"/>\n",
+                    "<meta name=\"zero-margin\" content=\"true\"/>\n",
+                    "<meta name=\"ke-border-color\" content=\"#FFFFFF\"/>\n",
+                    "<meta name=\"ke-border-width\" content=\"0\"/>\n"])
         if options.kfx:
-            f.writelines(["<meta name=\"orientation-lock\" content=\"none\"/>\n",
-                          "<meta name=\"region-mag\" content=\"false\"/>\n"])
+            opf.extend(["<meta name=\"orientation-lock\" content=\"none\"/>\n",
+                        "<meta name=\"region-mag\" content=\"false\"/>\n"])
         else:
-            f.writelines(["<meta name=\"orientation-lock\" content=\"portrait\"/>\n",
-                          "<meta name=\"region-mag\" content=\"true\"/>\n"])
+            opf.extend(["<meta name=\"orientation-lock\" content=\"portrait\"/>\n",
+                        "<meta name=\"region-mag\" content=\"true\"/>\n"])
     else:
-        f.writelines(["<meta property=\"rendition:orientation\">portrait</meta>\n",
-                      "<meta property=\"rendition:spread\">portrait</meta>\n",
-                      "<meta property=\"rendition:layout\">pre-paginated</meta>\n"])
-    f.writelines(["</metadata>\n<manifest>\n<item id=\"ncx\" href=\"toc.ncx\" ",
-                  "media-type=\"application/x-dtbncx+xml\"/>\n",
-                  "<item id=\"nav\" href=\"nav.xhtml\" ",
-                  "properties=\"nav\" media-type=\"application/xhtml+xml\"/>\n"])
+        opf.extend(["<meta property=\"rendition:orientation\">portrait</meta>\n",
+                    "<meta property=\"rendition:spread\">portrait</meta>\n",
+                    "<meta property=\"rendition:layout\">pre-paginated</meta>\n"])
+    opf.extend(["</metadata>\n<manifest>\n<item id=\"ncx\" href=\"toc.ncx\" ",
+                "media-type=\"application/x-dtbncx+xml\"/>\n",
+                "<item id=\"nav\" href=\"nav.xhtml\" ",
+                "properties=\"nav\" media-type=\"application/xhtml+xml\"/>\n"])
     if cover is not None:
         filename = getImageFileName(cover.replace(os.path.join(dstdir, 'OEBPS'), '').lstrip('/').lstrip('\\\\'))
         if '.png' == filename[1]:
             mt = 'image/png'
         else:
             mt = 'image/jpeg'
-        f.write("<item id=\"cover\" href=\"Images/cover" + filename[1] + "\" media-type=\"" + mt +
-                "\" properties=\"cover-image\"/>\n")
-    reflist = []
-    for path in filelist:
-        folder = path[0].replace(os.path.join(dstdir, 'OEBPS'), '').lstrip('/').lstrip('\\\\').replace("\\", "/")
-        filename = getImageFileName(path[1])
-        uniqueid = os.path.join(folder, filename[0]).replace('/', '_').replace('\\', '_')
-        reflist.append(uniqueid)
-        f.write("<item id=\"page_" + str(uniqueid) + "\" href=\"" +
-                folder.replace('Images', 'Text') + "/" + filename[0] +
-                ".xhtml\" media-type=\"application/xhtml+xml\"/>\n")
-        if '.png' == filename[1]:
-            mt = 'image/png'
-        else:
-            mt = 'image/jpeg'
-        f.write("<item id=\"img_" + str(uniqueid) + "\" href=\"" + folder + "/" + path[1] + "\" media-type=\"" +
-                mt + "\"/>\n")
-    f.write("<item id=\"css\" href=\"Text/style.css\" media-type=\"text/css\"/>\n")
+        opf.append("<item id=\"cover\" href=\"Images/cover" + filename[1] + "\" media-type=\"" + mt +
+                   "\" properties=\"cover-image\"/>\n")
+    opf.extend(manifest)
+    opf.append("<item id=\"css\" href=\"Text/style.css\" media-type=\"text/css\"/>\n")
     if options.righttoleft:
-        f.write("</manifest>\n<spine page-progression-direction=\"rtl\" toc=\"ncx\">\n")
+        opf.append("</manifest>\n<spine page-progression-direction=\"rtl\" toc=\"ncx\">\n")
         pageside = "right"
     else:
-        f.write("</manifest>\n<spine page-progression-direction=\"ltr\" toc=\"ncx\">\n")
+        opf.append("</manifest>\n<spine page-progression-direction=\"ltr\" toc=\"ncx\">\n")
         pageside = "left"
     if options.iskindle:
         for entry in reflist:
             if options.righttoleft:
                 if entry.endswith("-b"):
-                    f.write("<itemref idref=\"page_" + entry + "\" linear=\"yes\" properties=\"page-spread-right\"/>\n")
+                    opf.extend(["<itemref idref=\"page_", entry,
+                                "\" linear=\"yes\" properties=\"page-spread-right\"/>\n"])
                     pageside = "right"
                 elif entry.endswith("-c"):
-                    f.write("<itemref idref=\"page_" + entry + "\" linear=\"yes\" properties=\"page-spread-left\"/>\n")
+                    opf.extend(["<itemref idref=\"page_", entry,
+                                "\" linear=\"yes\" properties=\"page-spread-left\"/>\n"])
                     pageside = "right"
                 else:
-                    f.write("<itemref idref=\"page_" + entry + "\" linear=\"yes\" properties=\"page-spread-" +
-                            pageside + "\"/>\n")
+                    opf.extend(["<itemref idref=\"page_", entry, "\" linear=\"yes\" properties=\"page-spread-",
+                                pageside, "\"/>\n"])
                     if pageside == "right":
                         pageside = "left"
                     else:
                         pageside = "right"
             else:
                 if entry.endswith("-b"):
-                    f.write("<itemref idref=\"page_" + entry + "\" linear=\"yes\" properties=\"page-spread-left\"/>\n")
+                    opf.extend(["<itemref idref=\"page_", entry,
+                                "\" linear=\"yes\" properties=\"page-spread-left\"/>\n"])
                     pageside = "left"
                 elif entry.endswith("-c"):
-                    f.write("<itemref idref=\"page_" + entry + "\" linear=\"yes\" properties=\"page-spread-right\"/>\n")
+                    opf.extend(["<itemref idref=\"page_", entry,
+                                "\" linear=\"yes\" properties=\"page-spread-right\"/>\n"])
                     pageside = "left"
                 else:
-                    f.write("<itemref idref=\"page_" + entry + "\" linear=\"yes\" properties=\"page-spread-" +
-                            pageside + "\"/>\n")
+                    opf.extend(["<itemref idref=\"page_", entry, "\" linear=\"yes\" properties=\"page-spread-",
+                                pageside, "\"/>\n"])
                 if pageside == "right":
                     pageside = "left"
                 else:
                     pageside = "right"
     else:
         for entry in reflist:
-            f.write("<itemref idref=\"page_" + entry + "\"/>\n")
-    f.write("</spine>\n</package>\n")
-    f.close()
+            opf.extend(["<itemref idref=\"page_", entry, "\"/>\n"])
+    opf.append("</spine>\n</package>\n")
+    writeUTF8(opffile, opf)
     os.mkdir(os.path.join(dstdir, 'META-INF'))
     f = open(os.path.join(dstdir, 'META-INF', 'container.xml'), 'w', encoding='UTF-8')
     f.writelines(["<?xml version=\"1.0\"?>\n",
@@ -431,7 +399,6 @@ def buildOPF(dstdir, title, filelist, cover=None):
 
 
 def buildEPUB(path, chapternames, tomenumber):
-    filelist = []
     chapterlist = []
     cover = None
     os.mkdir(os.path.join(path, 'OEBPS', 'Text'))
@@ -510,19 +477,35 @@ def buildEPUB(path, chapternames, tomenumber):
                       "display: none;\n",
                       "}\n"])
     f.close()
-    for dirpath, dirnames, filenames in os.walk(os.path.join(path, 'OEBPS', 'Images')):
-        chapter = False
+    filelist = []
+    manifest = []
+    reflist = []
+    imagesroot = os.path.join(path, 'OEBPS', 'Images')
+    oebpslen = len(os.path.join(path, 'OEBPS')) + 1
+    for dirpath, dirnames, filenames in os.walk(imagesroot):
         dirnames, filenames = walkSort(dirnames, filenames)
+        folder = dirpath[oebpslen:].replace("\\", "/")
+        chapter = False
         for afile in filenames:
-            filelist.append(buildHTML(dirpath, afile, os.path.join(dirpath, afile)))
+            filelist.append(buildHTML(dirpath, afile, os.path.join(dirpath, afile), imagesroot))
+            filename = filelist[-1][2]
             if not chapter:
-                chapterlist.append((dirpath.replace('Images', 'Text'), filelist[-1][1]))
+                chapterlist.append((dirpath.replace('Images', 'Text'), afile, filename[0]))
                 chapter = True
-            if cover is None:
-                cover = os.path.join(os.path.join(path, 'OEBPS', 'Images'),
-                                     'cover' + getImageFileName(filelist[-1][1])[1])
-                options.covers.append((image.Cover(os.path.join(filelist[-1][0], filelist[-1][1]), cover, options,
-                                                   tomenumber), options.uuid))
+            uniqueid = os.path.join(folder, filename[0]).replace('/', '_').replace('\\', '_')
+            reflist.append(uniqueid)
+            if '.png' == filename[1]:
+                mt = 'image/png'
+            else:
+                mt = 'image/jpeg'
+            manifest.extend(["<item id=\"page_" + uniqueid + "\" href=\"" + folder.replace('Images', 'Text') +
+                             "/" + filename[0] + ".xhtml\" media-type=\"application/xhtml+xml\"/>\n",
+                             "<item id=\"img_" + uniqueid + "\" href=\"" + folder + "/" + afile +
+                             "\" media-type=\"" + mt + "\"/>\n"])
+    if filelist:
+        cover = os.path.join(imagesroot, 'cover' + filelist[0][2][1])
+        options.covers.append((image.Cover(os.path.join(filelist[0][0], filelist[0][1]), cover, options,
+                                           tomenumber), options.uuid))
     # Overwrite chapternames if tree is flat and ComicInfo.xml has bookmarks
     if not chapternames and options.chapters:
         chapterlist = []
@@ -535,32 +518,45 @@ def buildEPUB(path, chapternames, tomenumber):
             if '-kcc-c' in filelist[pageid][1]:
                 pageid -= 1
             filename = filelist[pageid][1]
-            chapterlist.append((filelist[pageid][0].replace('Images', 'Text'), filename))
+            chapterlist.append((filelist[pageid][0].replace('Images', 'Text'), filename, filelist[pageid][2][0]))
             chapternames[filename] = aChapter[1]
             globaldiff = pageid - (aChapter[0] + globaldiff)
-    buildNCX(path, options.title, chapterlist, chapternames)
-    buildNAV(path, options.title, chapterlist, chapternames)
-    buildOPF(path, options.title, filelist, cover)
+    chapters = []
+    title = options.title
+    for dirpath, afile, name in chapterlist:
+        folder = dirpath[oebpslen:]
+        href = os.path.join(folder, name)
+        navID = folder.replace('/', '_').replace('\\', '_')
+        if options.chapters:
+            title = chapternames[afile]
+            navID = href.replace('/', '_').replace('\\', '_')
+        elif os.path.basename(folder) != "Text":
+            title = chapternames[os.path.basename(folder)]
+        chapters.append((href.replace('\\', '/'), navID, hescape(title)))
+    buildNCX(path, options.title, chapters)
+    buildNAV(path, options.title, chapters)
+    buildOPF(path, options.title, manifest, reflist, cover)
 
 
 def imgDirectoryProcessing(path):
     global workerPool, workerOutput
-    workerPool = Pool(maxtasksperchild=100)
+    workerPool = Pool(maxtasksperchild=100, initializer=setWorkerOptions, initargs=(options, ))
     workerOutput = []
-    options.imgMetadata = {}
-    options.imgOld = []
     work = []
     pagenumber = 0
     for dirpath, _, filenames in os.walk(path):
         for afile in filenames:
             pagenumber += 1
             if not afile == "ComicInfo.xml":
-                work.append([afile, dirpath, options])
+                work.append([afile, dirpath])
     if GUI:
         GUI.progressBarTick.emit(str(pagenumber))
     if len(work) > 0:
-        for i in work:
-            workerPool.apply_async(func=imgFileProcessing, args=(i, ), callback=imgFileProcessingTick)
+        chunksize = max(1, len(work) // (4 * (os.cpu_count() or 1)))
+        for output in workerPool.imap_unordered(imgFileProcessing, work, chunksize):
+            imgFileProcessingTick(output)
+            if len(workerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                break
         workerPool.close()
         workerPool.join()
         if GUI and not GUI.conversionAlive:
@@ -569,9 +565,6 @@ def imgDirectoryProcessing(path):
         if len(workerOutput) > 0:
             rmtree(os.path.join(path, '..', '..'), True)
             raise RuntimeError("One of workers crashed. Cause: " + workerOutput[0][0], workerOutput[0][1])
-        for file in options.imgOld:
-            if os.path.isfile(file):
-                os.remove(file)
     else:
         rmtree(os.path.join(path, '..', '..'), True)
         raise UserWarning("Source directory is empty.")
@@ -585,7 +578,7 @@ def imgFileProcessingTick(output):
         for page in output:
             if page is not None:
                 options.imgMetadata[page[0]] = page[1]
-                options.imgOld.append(page[2])
+                options.imgSize[page[0]] = page[3]
     if GUI:
         GUI.progressBarTick.emit('tick')
         if not GUI.conversionAlive:
@@ -596,20 +589,20 @@ def imgFileProcessing(work):
     try:
         afile = work[0]
         dirpath = work[1]
-        opt = work[2]
         output = []
-        workImg = image.ComicPageParser((dirpath, afile), opt)
+        workImg = image.ComicPageParser((dirpath, afile), options)
         for i in workImg.payload:
-            img = image.ComicPage(opt, *i)
-            if opt.cropping == 2 and not opt.webtoon:
-                img.cropPageNumber(opt.croppingp, opt.croppingm)
-            if opt.cropping > 0 and not opt.webtoon:
-                img.cropMargin(opt.croppingp, opt.croppingm)
+            img = image.ComicPage(options, *i)
+            if options.cropping == 2 and not options.webtoon:
+                img.cropPageNumber(options.croppingp, options.croppingm)
+            if options.cropping > 0 and not options.webtoon:
+                img.cropMargin(options.croppingp, options.croppingm)
             img.autocontrastImage()
             img.resizeImage()
-            if opt.forcepng and not opt.forcecolor:
+            if options.forcepng and not options.forcecolor:
                 img.quantizeImage()
             output.append(img.saveToDir())
+        os.remove(os.path.join(dirpath, afile))
         return output
     except Exception:
         return str(sys.exc_info()[1]), sanitizeTrace(sys.exc_info()[2])
@@ -700,11 +693,9 @@ def getComicInfo(path, originalpath):
                 titleSuffix += ' #' + xml.data['Number'].zfill(3)
             options.title += titleSuffix
         for field in ['Writers', 'Pencillers', 'Inkers', 'Colorists']:
-            for person in xml.data[field]:
-                options.authors.append(hescape(person))
+            options.authors.extend(map(hescape, xml.data[field]))
         if len(options.authors) > 0:
-            options.authors = list(set(options.authors))
-            options.authors.sort()
+            options.authors = sorted(set(options.authors))
         else:
             options.authors = ['KCC']
         if xml.data['Bookmarks']:
@@ -731,65 +722,108 @@ def getPanelViewSize(deviceres, size):
     return str(int(x)), str(int(y))
 
 
-def sanitizeTree(filetree):
-    chapterNames = {}
-    for root, dirs, files in os.walk(filetree, False):
-        for name in files:
-            if not name == "ComicInfo.xml":
-                splitname = os.path.splitext(name)
-                slugified = slugify(splitname[0], False)
-                while os.path.exists(os.path.join(root, slugified + splitname[1])) and splitname[0].upper()\
-                        != slugified.upper():
-                    slugified += "A"
-                newKey = os.path.join(root, slugified + splitname[1])
-                key = os.path.join(root, name)
-                if key != newKey:
-                    os.replace(key, newKey)
-        for name in dirs:
-            tmpName = name
-            slugified = slugify(name, True)
-            while os.path.exists(os.path.join(root, slugified)) and name.upper() != slugified.upper():
+def sanitizeTree(filetree, kobo=False, chapters=True):
+    if kobo:
+        pageNumber = count()
+    else:
+        pageNumber = None
+    dirNames = sanitizeDirectory(filetree, pageNumber, chapters)
+    if chapters:
+        return dict(dirNames)
+    else:
+        return None
+
+
+def sanitizeDirectory(root, pageNumber, chapters):
+    with os.scandir(root) as it:
+        entries = list(it)
+    # Casefolded so a hit covers case-insensitive file systems, os.path.exists then has the final say
+    existing = set(entry.name.casefold() for entry in entries)
+    files = {}
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir():
+            subdirs.append(entry)
+        elif not entry.name == "ComicInfo.xml":
+            name = entry.name
+            splitname = os.path.splitext(name)
+            slugified = slugify(splitname[0], False)
+            while nameTaken(root, slugified + splitname[1], existing) and splitname[0].upper() != slugified.upper():
+                slugified += "A"
+            newKey = os.path.join(root, slugified + splitname[1])
+            if entry.path != newKey:
+                os.replace(entry.path, newKey)
+                moveImageMetadata(entry.path, newKey)
+                existing.add((slugified + splitname[1]).casefold())
+            files[slugified + splitname[1]] = None
+    # Directory contents never depend on the directory name, so renaming it before descending gives the same
+    # result as the old bottom-up walk while the Kobo numbering below can follow the renamed, sorted order
+    dirs = []
+    for entry in subdirs:
+        name = entry.name
+        slugified = slugify(name, True)
+        while nameTaken(root, slugified, existing) and name.upper() != slugified.upper():
+            slugified += "A"
+        newKey = os.path.join(root, slugified)
+        if entry.path != newKey:
+            os.replace(entry.path, newKey)
+            moveImageMetadata(entry.path, newKey)
+            existing.add(slugified.casefold())
+        dirs.append((slugified, name, entry.is_symlink()))
+    if pageNumber is not None:
+        for name in sorted(files, key=walkSortKey):
+            splitname = os.path.splitext(name)
+            slugified = str(next(pageNumber)).zfill(5)
+            while nameTaken(root, slugified + splitname[1], existing) and splitname[0].upper() != slugified.upper():
                 slugified += "A"
-            chapterNames[slugified] = tmpName
-            newKey = os.path.join(root, slugified)
+            newKey = os.path.join(root, slugified + splitname[1])
             key = os.path.join(root, name)
             if key != newKey:
                 os.replace(key, newKey)
-    return chapterNames
-
-
-def sanitizeTreeKobo(filetree):
-    pageNumber = 0
-    for root, dirs, files in os.walk(filetree):
-        dirs, files = walkSort(dirs, files)
-        for name in files:
-            if not name == "ComicInfo.xml":
-                splitname = os.path.splitext(name)
-                slugified = str(pageNumber).zfill(5)
-                pageNumber += 1
-                while os.path.exists(os.path.join(root, slugified + splitname[1])) and splitname[0].upper()\
-                        != slugified.upper():
-                    slugified += "A"
-                newKey = os.path.join(root, slugified + splitname[1])
-                key = os.path.join(root, name)
-                if key != newKey:
-                    os.replace(key, newKey)
+                existing.add((slugified + splitname[1]).casefold())
+    # Descend in walkSort order for page numbering, but report titles in listing order and after the nested
+    # ones, as os.walk(topdown=False) recorded them
+    childNames = {}
+    for slugified, name, symlink in sorted(dirs, key=lambda d: walkSortKey(d[0])):
+        if not symlink:
+            childNames[slugified] = sanitizeDirectory(os.path.join(root, slugified), pageNumber, chapters)
+    dirNames = []
+    if chapters:
+        for slugified, name, symlink in dirs:
+            dirNames.extend(childNames.get(slugified, ()))
+        dirNames.extend((slugified, name) for slugified, name, symlink in dirs)
+    return dirNames
+
+
+def nameTaken(root, name, existing):
+    # Renamed away names stay in the set, a stale hit only costs the exists call
+    return name.casefold() in existing and os.path.exists(os.path.join(root, name))
+
+
+def getImagesLevel(path, level=1):
+    imagesLevel = -1
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                newLevel = getImagesLevel(entry.path, level + 1)
+            elif getImageFileName(entry.name) is not None:
+                newLevel = level
+            else:
+                continue
+            if newLevel == -1:
+                continue
+            # Stop as soon as images are found at different depths
+            if newLevel == 0 or (imagesLevel != -1 and imagesLevel != newLevel):
+                return 0
+            imagesLevel = newLevel
+    return imagesLevel
 
 
 def splitDirectory(path):
-    level = -1
-    for root, _, files in os.walk(os.path.join(path, 'OEBPS', 'Images')):
-        for f in files:
-            if f.endswith('.jpg') or f.endswith('.jpeg') or f.endswith('.png') or f.endswith('.gif') or \
-                    f.endswith('.webp'):
-                newLevel = os.path.join(root, f).replace(os.path.join(path, 'OEBPS', 'Images'), '').count(os.sep)
-                if level != -1 and level != newLevel:
-                    level = 0
-                    break
-                else:
-                    level = newLevel
+    imagesPath = os.path.join(path, 'OEBPS', 'Images')
+    level = getImagesLevel(imagesPath)
     if level > 0:
-        splitter = splitProcess(os.path.join(path, 'OEBPS', 'Images'), level)
+        splitter = splitProcess(imagesPath, level)
         path = [path]
         for tome in splitter:
             path.append(tome)
@@ -811,20 +845,22 @@ def splitProcess(path, mode):
     if options.batchsplit == 2 and mode == 2:
         mode = 3
     if mode < 3:
-        for root, dirs, files in walkLevel(path, 0):
-            for name in files if mode == 1 else dirs:
-                if mode == 1:
-                    size = os.path.getsize(os.path.join(root, name))
-                else:
-                    size = getDirectorySize(os.path.join(root, name))
-                if currentSize + size > targetSize:
-                    currentTarget, pathRoot = createNewTome()
-                    output.append(pathRoot)
-                    currentSize = size
-                else:
-                    currentSize += size
-                if path != currentTarget:
-                    move(os.path.join(root, name), os.path.join(currentTarget, name))
+        with os.scandir(path) as it:
+            entries = {entry.name: entry for entry in it if entry.is_dir() == (mode == 2)}
+        for name in sorted(entries, key=walkSortKey):
+            if mode == 1:
+                size = entries[name].stat().st_size
+            else:
+                size = getDirectorySize(entries[name].path)
+            if currentSize + size > targetSize:
+                currentTarget, pathRoot = createNewTome()
+                output.append(pathRoot)
+                currentSize = size
+            else:
+                currentSize += size
+            if path != currentTarget:
+                moveTree(os.path.join(path, name), os.path.join(currentTarget, name))
+                moveImageMetadata(os.path.join(path, name), os.path.join(currentTarget, name))
     else:
         firstTome = True
         for root, dirs, _ in walkLevel(path, 0):
@@ -832,44 +868,70 @@ def splitProcess(path, mode):
                 if not firstTome:
                     currentTarget, pathRoot = createNewTome()
                     output.append(pathRoot)
-                    move(os.path.join(root, name), os.path.join(currentTarget, name))
+                    moveTree(os.path.join(root, name), os.path.join(currentTarget, name))
+                    moveImageMetadata(os.path.join(root, name), os.path.join(currentTarget, name))
                 else:
                     firstTome = False
     return output
 
 
+def moveTree(source, target):
+    try:
+        os.replace(source, target)
+    except OSError as err:
+        if err.errno == EXDEV:
+            move(source, target)
+        else:
+            raise
+
+
+def moveImageMetadata(source, target):
+    if source in options.imgMetadata:
+        options.imgMetadata[target] = options.imgMetadata.pop(source)
+        options.imgSize[target] = options.imgSize.pop(source)
+    else:
+        source = os.path.join(source, '')
+        for key in [key for key in options.imgMetadata if key.startswith(source)]:
+            newKey = os.path.join(target, key[len(source):])
+            options.imgMetadata[newKey] = options.imgMetadata.pop(key)
+            options.imgSize[newKey] = options.imgSize.pop(key)
+
+
 def detectCorruption(tmppath, orgpath):
     imageNumber = 0
     imageSmaller = 0
     alreadyProcessed = False
-    for root, _, files in os.walk(tmppath, False):
-        for name in files:
-            if getImageFileName(name) is not None:
-                if not alreadyProcessed and getImageFileName(name)[0].endswith('-kcc'):
-                    alreadyProcessed = True
-                path = os.path.join(root, name)
-                pathOrg = orgpath + path.split('OEBPS' + os.path.sep + 'Images')[1]
-                if os.path.getsize(path) == 0:
-                    rmtree(os.path.join(tmppath, '..', '..'), True)
-                    raise RuntimeError('Image file %s is corrupted.' % pathOrg)
-                try:
-                    img = Image.open(path)
-                    img.verify()
-                    img = Image.open(path)
+    tmppathlen = len(tmppath)
+    for entry in walkFiles(tmppath):
+        name = entry.name
+        filename = getImageFileName(name)
+        if filename is not None:
+            if not alreadyProcessed and filename[0].endswith('-kcc'):
+                alreadyProcessed = True
+            pathOrg = orgpath + entry.path[tmppathlen:]
+            if entry.stat().st_size == 0:
+                rmtree(os.path.join(tmppath, '..', '..'), True)
+                raise RuntimeError('Image file %s is corrupted.' % pathOrg)
+            try:
+                with Image.open(entry.path) as img:
+                    size = img.size
+                    # Decoding JPEG at reduced scale still reads the whole stream
+                    if img.format == 'JPEG':
+                        img.draft(img.mode, (1, 1))
                     img.load()
-                    imageNumber += 1
-                    if options.profileData[1][0] > img.size[0] and options.profileData[1][1] > img.size[1]:
-                        imageSmaller += 1
-                except Exception as err:
-                    rmtree(os.path.join(tmppath, '..', '..'), True)
-                    if 'decoder' in str(err) and 'not available' in str(err):
-                        raise RuntimeError('Pillow was compiled without JPG and/or PNG decoder.')
-                    else:
-                        raise RuntimeError('Image file %s is corrupted. Error: %s' % (pathOrg, str(err)))
-            elif options.copycomicinfo and name == "ComicInfo.xml":
-                pass
-            else:
-                os.remove(os.path.join(root, name))
+                imageNumber += 1
+                if options.profileData[1][0] > size[0] and options.profileData[1][1] > size[1]:
+                    imageSmaller += 1
+            except Exception as err:
+                rmtree(os.path.join(tmppath, '..', '..'), True)
+                if 'decoder' in str(err) and 'not available' in str(err):
+                    raise RuntimeError('Pillow was compiled without JPG and/or PNG decoder.')
+                else:
+                    raise RuntimeError('Image file %s is corrupted. Error: %s' % (pathOrg, str(err)))
+        elif options.copycomicinfo and name == "ComicInfo.xml":
+            pass
+        else:
+            os.remove(entry.path)
     if alreadyProcessed:
         if options.skipexisting > 1:
             alreadyprocessedlist.append(os.path.normpath(orgpath))
@@ -906,25 +968,56 @@ def createNewTome():
 
 def slugify(value, isdir):
     if isdir:
-        value = slugifyExt(value, regex_pattern=r'[^-a-z0-9_\.]+').strip('.')
+        value = slugifyExt(value, regex_pattern=slugifyDirPattern).strip('.')
     else:
         value = slugifyExt(value).strip('.')
-    value = sub(r'0*([0-9]{4,})', r'\1', sub(r'([0-9]+)', r'0000\1', value, count=2))
+    value = slugifyPaddingPattern.sub(r'\1', slugifyNumberPattern.sub(r'0000\1', value, count=2))
     return value
 
 
+class DeflateCompressor:
+    def __init__(self, level):
+        self.level = level
+        self.data = []
+
+    def compress(self, data):
+        self.data.append(bytes(data))
+        return b''
+
+    def flush(self):
+        return deflate_compress(b''.join(self.data), self.level)
+
+
+class DeflateZipFile(ZipFile):
+    # Swap zlib for libdeflate when writing DEFLATE entries
+    def _open_to_write(self, zinfo, force_zip64=False):
+        zipEntry = super()._open_to_write(zinfo, force_zip64)
+        if zinfo.compress_type == ZIP_DEFLATED:
+            zipEntry._compressor = DeflateCompressor(self.compresslevel)
+        return zipEntry
+
+
 def makeZIP(zipfilename, basedir, isepub=False):
     zipfilename = os.path.abspath(zipfilename) + '.zip'
-    zipOutput = ZipFile(zipfilename, 'w', ZIP_DEFLATED)
-    if isepub:
-        zipOutput.writestr('mimetype', 'application/epub+zip', ZIP_STORED)
-    for dirpath, _, filenames in os.walk(basedir):
-        for name in filenames:
-            path = os.path.normpath(os.path.join(dirpath, name))
-            aPath = os.path.normpath(os.path.join(dirpath.replace(basedir, ''), name))
-            if os.path.isfile(path):
-                zipOutput.write(path, aPath)
-    zipOutput.close()
+    # Large buffer coalesces the many small entry writes
+    with open(zipfilename, 'wb', buffering=1 << 20) as zipFile:
+        if deflate_compress:
+            zipOutput = DeflateZipFile(zipFile, 'w', ZIP_DEFLATED, compresslevel=options.zipcompresslevel)
+        else:
+            zipOutput = ZipFile(zipFile, 'w', ZIP_DEFLATED, compresslevel=options.zipcompresslevel)
+        if isepub:
+            zipOutput.writestr('mimetype', 'application/epub+zip', ZIP_STORED)
+        for dirpath, _, filenames in os.walk(basedir):
+            aDirpath = dirpath.replace(basedir, '')
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                aPath = os.path.join(aDirpath, name)
+                if os.path.isfile(path):
+                    if name.lower().endswith(imageExtensions):
+                        zipOutput.write(path, aPath, ZIP_STORED)
+                    else:
+                        zipOutput.write(path, aPath)
+        zipOutput.close()
     return zipfilename
 
 
@@ -937,7 +1030,7 @@ def makeParser():
     outputOptions = psr.add_argument_group("OUTPUT SETTINGS")
     customProfileOptions = psr.add_argument_group("CUSTOM PROFILE")
     otherOptions = psr.add_argument_group("OTHER")
-    profiles = image.ProfileData().getRows("Profile")
+    profiles = image.getProfileData().getRows("Profile")
     formats = ["Auto", "MOBI", "EPUB", "CBZ", "KFX"]
 
     mandatoryOptions.add_argument("input", action="extend", nargs="*", default=None,
@@ -981,6 +1074,9 @@ def makeParser():
                                help="Pad \"_kcc(#)\" with given number of zeros. [Default=%(default)s]")
     outputOptions.add_argument("--cci", "--copycomicinfo", action="store_true", dest="copycomicinfo", default=False,
                                help="Copy ComicInfo.xml to generated file")
+    outputOptions.add_argument("--zc", "--zip-compresslevel", type=int, dest="zipcompresslevel", default="6",
+                               choices=range(1, 10), help="Compression level of text files in generated"
+                               " EPUB/CBZ files. Images are stored without compression. [Default=%(default)s]")
 
     processingOptions.add_argument("-n", "--noprocessing", action="store_true", dest="noprocessing", default=False,
                                    help="Do not modify image and ignore any profile or processing option")
@@ -1026,7 +1122,7 @@ def makeParser():
 
 def optionsHelp():
     if options.help[0] == "profile":
-        print(image.ProfileData().getAllProfiles())
+        print(image.getProfileData().getAllProfiles())
     elif options.help[0] == "bordercolor":
         import pandas as pd
         namedcolors = pd.DataFrame(ImageColor.colormap.items(), columns=['Named Color', 'Hex Value'])
@@ -1041,7 +1137,7 @@ def optionsHelp():
 
 def checkOptions():
     global options
-    profilematch = image.ProfileData().checkProfileMatch
+    profilematch = image.getProfileData().checkProfileMatch
     options.panelview = True
     options.iskindle = False
     options.kfx = False
@@ -1093,20 +1189,20 @@ def checkOptions():
         options.kfx = True
         options.panelview = False
     # Override profile data
+    profileData = image.getProfileData().profiles(options.profile)
     if options.customwidth != 0 or options.customheight != 0:
-        X = image.ProfileData().profiles(options.profile)[1][0]
-        Y = image.ProfileData().profiles(options.profile)[1][1]
+        X = profileData[1][0]
+        Y = profileData[1][1]
         if options.customwidth != 0:
             X = options.customwidth
         if options.customheight != 0:
             Y = options.customheight
-        newProfile = ("Custom", (int(X), int(Y)), image.ProfileData.Palette16,
-                      image.ProfileData().profiles(options.profile)[3])
+        newProfile = ("Custom", (int(X), int(Y)), image.ProfileData.Palette16, profileData[3])
         # image.ProfileData.Profiles["Custom"] = newProfile
         options.profile = "Custom"
         options.profileData = newProfile
     else:
-        options.profileData = image.ProfileData().profiles(options.profile)
+        options.profileData = profileData
     # Only copy ComicInfo.xml to .cbz files
     if not options.format == "CBZ" and options.copycomicinfo:
         raise UserWarning("ERROR: Can only copy ComicInfo.xml to CBZ format. Either change format or don't use the"
@@ -1114,33 +1210,33 @@ def checkOptions():
     # Only allow named color or hexadecimal border color
     if options.bordersColor:
         if not options.bordersColor in ImageColor.colormap.keys() and \
-                not compile(r"^#?([0-9a-f]{3}){1,2}$").match(options.bordersColor):
+                not bordersColorPattern.match(options.bordersColor):
             raise UserWarning("ERROR: Border color must be a hexadecimal color or one of the named colors.")
 
 
+@lru_cache(maxsize=None)
+def isToolAvailable(tool):
+    return which(tool) is not None
+
+
 def checkTools(source):
     source = source.upper()
-    if source.endswith('.CB7') or source.endswith('.7Z') or source.endswith('.RAR') or source.endswith('.CBR') or \
-            source.endswith('.ZIP') or source.endswith('.CBZ'):
-        process = Popen('7z', stdout=PIPE, stderr=STDOUT, stdin=PIPE, shell=True)
-        process.communicate()
-        if process.returncode != 0 and process.returncode != 7:
-            print('ERROR: 7z is missing!')
-            exit(1)
-    if options.format == 'MOBI':
-        kindleGenExitCode = Popen('kindlegen -locale en', stdout=PIPE, stderr=STDOUT, stdin=PIPE, shell=True)
-        kindleGenExitCode.communicate()
-        if kindleGenExitCode.returncode != 0:
-            print('ERROR: KindleGen is missing!')
-            exit(1)
+    if source.endswith(('.CB7', '.7Z', '.RAR', '.CBR', '.ZIP', '.CBZ')) and not isToolAvailable('7z'):
+        print('ERROR: 7z is missing!')
+        exit(1)
+    if options.format == 'MOBI' and not isToolAvailable('kindlegen'):
+        print('ERROR: KindleGen is missing!')
+        exit(1)
 
 
 def checkPre(source):
     # Make sure that all temporary files are gone
-    for root, dirs, _ in walkLevel(gettempdir(), 0):
-        for tempdir in dirs:
-            if tempdir.startswith('KCC-'):
-                rmtree(os.path.join(root, tempdir), True)
+    with os.scandir(gettempdir()) as it:
+        tempdirs = [entry.path for entry in it if entry.name.startswith('KCC-') and entry.is_dir()]
+    if tempdirs:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for tempdir in tempdirs:
+                executor.submit(rmtree, tempdir, True)
     # Make sure that target directory is writable
     if os.path.isdir(source):
         src = os.path.abspath(os.path.join(source, '..'))
@@ -1197,11 +1293,14 @@ def makeBook(source, qtgui=None):
     if not checkPre(source):
         print("Preparing source images...")
         path = getWorkFolder(source, "KCC-")
+        imagesPath = os.path.join(path, "OEBPS", "Images")
+        options.imgMetadata = {}
+        options.imgSize = {}
         print("Checking images...")
-        getComicInfo(os.path.join(path, "OEBPS", "Images"), source)
-        if not detectCorruption(os.path.join(path, "OEBPS", "Images"), source):
+        getComicInfo(imagesPath, source)
+        if not detectCorruption(imagesPath, source):
             if options.webtoon:
-                y = image.ProfileData().profiles(options.profile)[1][1]
+                y = image.getProfileData().profiles(options.profile)[1][1]
                 comic2panel.main(['-y ' + str(y), '-i', '-m', path], qtgui)
             if options.noprocessing:
                 print("Do not process image. Ignore any profile or processing option.")
@@ -1218,12 +1317,11 @@ def makeBook(source, qtgui=None):
                 print("Processing images...")
                 if GUI:
                     GUI.progressBarTick.emit('Processing images')
-                imgDirectoryProcessing(os.path.join(path, "OEBPS", "Images"))
+                imgDirectoryProcessing(imagesPath)
             if GUI:
                 GUI.progressBarTick.emit('1')
-            chapterNames = sanitizeTree(os.path.join(path, 'OEBPS', 'Images'))
-            if 'Ko' in options.profile and options.format == 'CBZ':
-                sanitizeTreeKobo(os.path.join(path, 'OEBPS', 'Images'))
+            chapterNames = sanitizeTree(imagesPath, 'Ko' in options.profile and options.format == 'CBZ',
+                                        options.format != 'CBZ')
             if options.batchsplit > 0:
                 tomes = splitDirectory(path)
             else:
@@ -1269,12 +1367,7 @@ def makeBook(source, qtgui=None):
                         os.makedirs(os.path.split(filepath[-1])[0])
                     except:
                         raise UserWarning("Unable to recreate the directory tree in the ouput directory.")
-                copyfile(tome + '_comic.zip', filepath[-1])
-                try:
-                    os.remove(tome + '_comic.zip')
-                except FileNotFoundError:
-                    # newly temporary created file is not found. It might have been already deleted
-                    pass
+                moveTree(tome + '_comic.zip', filepath[-1])
                 if filepath and not os.path.normpath(filepath[-1]) in copyprocessedlist:
                     completedlist.append(filepath[-1])
                 rmtree(tome, True)
@@ -1294,15 +1387,16 @@ def makeBook(source, qtgui=None):
                 k = kindle.Kindle()
                 if k.path and k.coverSupport:
                     print("Kindle detected. Uploading covers...")
-                for i in filepath:
-                    output = makeMOBIFix(i, options.covers[filepath.index(i)][1])
+                for idx, i in enumerate(filepath):
+                    cover = options.covers[idx]
+                    output = makeMOBIFix(i, cover[1])
                     if not output[0]:
                         print('Error: Failed to tweak KindleGen output!')
                         return filepath
                     else:
                         os.remove(i.replace('.epub', '.mobi') + '_toclean')
                     if k.path and k.coverSupport:
-                        options.covers[filepath.index(i)][0].saveToKindle(k, options.covers[filepath.index(i)][1])
+                        cover[0].saveToKindle(k, cover[1])
         else:
             rmtree(path, True)
             filepath = []
@@ -1338,8 +1432,8 @@ def makeMOBIWorker(item):
     kindlegenError = ''
     try:
         if os.path.getsize(item) < 629145600:
-            output = Popen('kindlegen -dont_append_source -locale en "' + item + '"',
-                           stdout=PIPE, stderr=STDOUT, stdin=PIPE, shell=True)
+            output = Popen(['kindlegen', '-dont_append_source', '-locale', 'en', item],
+                           stdout=PIPE, stderr=STDOUT, stdin=DEVNULL)
             for line in output.stdout:
                 line = line.decode('utf-8')
                 # ERROR: Generic error
@@ -1353,6 +1447,13 @@ def makeMOBIWorker(item):
                     break
                 if ":I1036: Mobi file built successfully" in line:
                     output.terminate()
+                    output.stdout.close()
+                    try:
+                        output.wait(timeout=5)
+                    except TimeoutExpired:
+                        output.kill()
+                        output.wait()
+                    break
         else:
             # ERROR: EPUB too big
             kindlegenErrorCode = 23026
@@ -1378,8 +1479,11 @@ def makeMOBI(work, qtgui=None):
     else:
         threadNumber = None
     makeMOBIWorkerPool = Pool(threadNumber, maxtasksperchild=10)
-    for i in work:
-        makeMOBIWorkerPool.apply_async(func=makeMOBIWorker, args=(i, ), callback=makeMOBIWorkerTick)
+    # Each task is a kindlegen run, batching them would leave workers idle at the end
+    for output in makeMOBIWorkerPool.imap_unordered(makeMOBIWorker, work):
+        makeMOBIWorkerTick(output)
+        if output[0] != 0 or (GUI and not GUI.conversionAlive):
+            break
     makeMOBIWorkerPool.close()
     makeMOBIWorkerPool.join()
     return makeMOBIWorkerOutput
@@ -23,8 +23,9 @@ import sys
 from shutil import rmtree, copytree
 from argparse import ArgumentParser
 from multiprocessing import Pool
-from PIL import Image, ImageChops, ImageOps, ImageDraw
-from .shared import getImageFileName, walkLevel, walkSort, sanitizeTrace, getWorkFolder
+import numpy as np
+from PIL import Image, ImageOps, ImageDraw
+from .shared import getImageFileName, walkLevel, walkSort, sanitizeTrace, getWorkFolder, getImageSize
 try:
     from PyQt5 import QtCore
 except ImportError:
@@ -54,9 +55,9 @@ def mergeDirectory(work):
         for root, _, files in walkLevel(directory, 0):
             for name in files:
                 if getImageFileName(name) is not None:
-                    i = Image.open(os.path.join(root, name))
-                    images.append([os.path.join(root, name), i.size[0], i.size[1]])
-                    sizes.append(i.size[0])
+                    width, height = getImageSize(os.path.join(root, name))
+                    images.append([os.path.join(root, name), width, height])
+                    sizes.append(width)
         if len(images) > 0:
             targetWidth = max(set(sizes), key=sizes.count)
             for i in images:
@@ -66,28 +67,32 @@ def mergeDirectory(work):
             # 131072 = GIMP_MAX_IMAGE_SIZE / 4
             if targetHeight > 131072:
                 return None
-            result = Image.new('RGB', (targetWidth, targetHeight))
+            result = np.zeros((targetHeight, targetWidth, 3), dtype=np.uint8)
             y = 0
             for i in imagesValid:
-                img = Image.open(i).convert('RGB')
+                with Image.open(i) as source:
+                    img = source.convert('RGB')
                 if img.size[0] < targetWidth or img.size[0] > targetWidth:
                     widthPercent = (targetWidth / float(img.size[0]))
                     heightSize = int((float(img.size[1]) * float(widthPercent)))
                     img = ImageOps.fit(img, (targetWidth, heightSize), method=Image.Resampling.BICUBIC,
                                        centering=(0.5, 0.5))
-                result.paste(img, (0, y))
+                # Upscaled pages can push the strip past targetHeight, the overflow is cropped
+                pixels = np.asarray(img)[:max(targetHeight - y, 0)]
+                result[y:y + pixels.shape[0]] = pixels
                 y += img.size[1]
-                os.remove(i)
+                img.close()
+                del img, pixels
             savePath = os.path.split(imagesValid[0])
-            result.save(os.path.join(savePath[0], os.path.splitext(savePath[1])[0] + '.png'), 'PNG')
+            savePath = os.path.join(savePath[0], os.path.splitext(savePath[1])[0] + '.png')
+            Image.fromarray(result).save(savePath, 'PNG', compress_level=1)
+            for i in imagesValid:
+                if i != savePath:
+                    os.remove(i)
     except Exception:
         return str(sys.exc_info()[1]), sanitizeTrace(sys.exc_info()[2])
 
 
-def detectSolid(img):
-    return not ImageChops.invert(img).getbbox() or not img.getbbox()
-
-
 def splitImageTick(output):
     if output:
         splitWorkerOutput.append(output)
@@ -108,7 +113,7 @@ def splitImage(work):
         Image.warnings.simplefilter('error', Image.DecompressionBombWarning)
         Image.MAX_IMAGE_PIXELS = 1000000000
         imgOrg = Image.open(filePath).convert('RGB')
-        imgProcess = Image.open(filePath).convert('1')
+        imgProcess = imgOrg.convert('1')
         widthImg, heightImg = imgOrg.size
         if heightImg > opt.height:
             if opt.debug:
@@ -116,25 +121,20 @@ def splitImage(work):
                 draw = ImageDraw.Draw(drawImg)
 
             # Find panels
-            yWork = 0
-            panelDetected = False
+            # Every 5th row starts a 4px high stripe, rows past the bottom edge count as black
+            stripes = (heightImg + 4) // 5
+            mask = np.asarray(imgProcess, dtype=bool)[:, 4:widthImg - 4]
+            rowWhite = np.zeros(stripes * 5, dtype=bool)
+            rowInk = np.zeros(stripes * 5, dtype=bool)
+            rowWhite[:heightImg] = mask.all(axis=1)
+            rowInk[:heightImg] = mask.any(axis=1)
+            solid = rowWhite.reshape(stripes, 5)[:, :4].all(axis=1) | ~rowInk.reshape(stripes, 5)[:, :4].any(axis=1)
+            edges = np.flatnonzero(np.diff(np.concatenate(([False], ~solid, [False])).astype(np.int8)))
             panels = []
-            while yWork < heightImg:
-                tmpImg = imgProcess.crop([4, yWork, widthImg-4, yWork + 4])
-                solid = detectSolid(tmpImg)
-                if not solid and not panelDetected:
-                    panelDetected = True
-                    panelY1 = yWork - 2
-                if heightImg - yWork <= 5:
-                    if not solid and panelDetected:
-                        panelY2 = heightImg
-                        panelDetected = False
-                        panels.append((panelY1, panelY2, panelY2 - panelY1))
-                if solid and panelDetected:
-                    panelDetected = False
-                    panelY2 = yWork + 6
-                    panels.append((panelY1, panelY2, panelY2 - panelY1))
-                yWork += 5
+            for panelStart, panelEnd in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+                panelY1 = panelStart * 5 - 2
+                panelY2 = heightImg if panelEnd == stripes else panelEnd * 5 + 6
+                panels.append((panelY1, panelY2, panelY2 - panelY1))
 
             # Split too big panels
             panelsProcessed = []
@@ -177,6 +177,8 @@ def splitImage(work):
                 pages.append(currentPage)
 
             # Create pages
+            # Panels may reach past the image edges, those rows stay black like in a PIL crop
+            imgArray = np.asarray(imgOrg)
             pageNumber = 1
             for page in pages:
                 pageHeight = 0
@@ -184,12 +186,16 @@ def splitImage(work):
                 for panel in page:
                     pageHeight += panelsProcessed[panel][2]
                 if pageHeight > 15:
-                    newPage = Image.new('RGB', (widthImg, pageHeight))
+                    newPage = np.zeros((pageHeight, widthImg, 3), dtype=np.uint8)
                     for panel in page:
-                        panelImg = imgOrg.crop([0, panelsProcessed[panel][0], widthImg, panelsProcessed[panel][1]])
-                        newPage.paste(panelImg, (0, targetHeight))
-                        targetHeight += panelsProcessed[panel][2]
-                    newPage.save(os.path.join(path, os.path.splitext(name)[0] + '-' + str(pageNumber) + '.png'), 'PNG')
+                        panelY1, panelY2, panelHeight = panelsProcessed[panel]
+                        top = max(panelY1, 0)
+                        bottom = min(panelY2, heightImg, panelY1 + pageHeight - targetHeight)
+                        if bottom > top:
+                            newPage[targetHeight + top - panelY1:targetHeight + bottom - panelY1] = imgArray[top:bottom]
+                        targetHeight += panelHeight
+                    Image.fromarray(newPage).save(os.path.join(path, os.path.splitext(name)[0] + '-' +
+                                                               str(pageNumber) + '.png'), 'PNG', compress_level=1)
                     pageNumber += 1
             os.remove(filePath)
     except Exception:
@@ -273,8 +279,11 @@ def main(argv=None, qtgui=None):
                     if GUI:
                         GUI.progressBarTick.emit('Combining images')
                         GUI.progressBarTick.emit(str(directoryNumer))
-                    for i in mergeWork:
-                        mergeWorkerPool.apply_async(func=mergeDirectory, args=(i, ), callback=mergeDirectoryTick)
+                    chunksize = max(1, len(mergeWork) // (4 * (os.cpu_count() or 1)))
+                    for output in mergeWorkerPool.imap_unordered(mergeDirectory, mergeWork, chunksize):
+                        mergeDirectoryTick(output)
+                        if len(mergeWorkerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                            break
                     mergeWorkerPool.close()
                     mergeWorkerPool.join()
                     if GUI and not GUI.conversionAlive:
@@ -297,8 +306,11 @@ def main(argv=None, qtgui=None):
                     GUI.progressBarTick.emit(str(pagenumber))
                     GUI.progressBarTick.emit('tick')
                 if len(work) > 0:
-                    for i in work:
-                        splitWorkerPool.apply_async(func=splitImage, args=(i, ), callback=splitImageTick)
+                    chunksize = max(1, len(work) // (4 * (os.cpu_count() or 1)))
+                    for output in splitWorkerPool.imap_unordered(splitImage, work, chunksize):
+                        splitImageTick(output)
+                        if len(splitWorkerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                            break
                     splitWorkerPool.close()
                     splitWorkerPool.join()
                     if GUI and not GUI.conversionAlive:
@@ -21,9 +21,9 @@
 import io
 import os
 import pandas as pd
+from functools import lru_cache
 import mozjpeg_lossless_optimization
 from PIL import Image, ImageOps, ImageStat, ImageChops, ImageFilter
-from .shared import md5Checksum
 
 
 class ProfileData:
@@ -106,22 +106,27 @@ class ProfileData:
             return False
 
     def profiles(self, profile):
-        self.df.set_index("Profile", inplace=True)
+        df = self.df.set_index("Profile")
         try:
-            model = self.df.loc[profile, "Model"][-1]
-            width = self.df.loc[profile, "Width"][-1]
-            height = self.df.loc[profile, "Height"][-1]
-            palette = "Palette" + str(self.df.loc[profile, "Palette"][-1])
-            gamma = self.df.loc[profile, "Gamma"][-1]
+            model = df.loc[profile, "Model"][-1]
+            width = df.loc[profile, "Width"][-1]
+            height = df.loc[profile, "Height"][-1]
+            palette = "Palette" + str(df.loc[profile, "Palette"][-1])
+            gamma = df.loc[profile, "Gamma"][-1]
         except IndexError:
-            model = self.df.loc[profile, "Model"]
-            width = self.df.loc[profile, "Width"]
-            height = self.df.loc[profile, "Height"]
-            palette = "Palette" + str(self.df.loc[profile, "Palette"])
-            gamma = self.df.loc[profile, "Gamma"]
+            model = df.loc[profile, "Model"]
+            width = df.loc[profile, "Width"]
+            height = df.loc[profile, "Height"]
+            palette = "Palette" + str(df.loc[profile, "Palette"])
+            gamma = df.loc[profile, "Gamma"]
         return (model, (width, height), palette, gamma)
 
 
+@lru_cache(maxsize=None)
+def getProfileData():
+    return ProfileData()
+
+
 class ComicPageParser:
     def __init__(self, source, options):
         Image.MAX_IMAGE_PIXELS = int(2048 * 2048 * 2048 // 4 // 3)
@@ -130,7 +135,8 @@ class ComicPageParser:
         self.size = self.opt.profileData[1]
         self.payload = []
         if not source[0] == "ComicInfo.xml":
-            self.image = Image.open(os.path.join(source[0], source[1])).convert('RGB')
+            with Image.open(os.path.join(source[0], source[1])) as image:
+                self.image = image.convert('RGB')
         self.color = self.colorCheck()
         self.fill = self.fillCheck()
         self.splitCheck()
@@ -204,7 +210,7 @@ class ComicPageParser:
         else:
             bw = self.image.convert('L').point(lambda x: 0 if x < 128 else 255, '1')
             imageBoxA = bw.getbbox()
-            imageBoxB = ImageChops.invert(bw).getbbox()
+            imageBoxB = ImageChops.invert(bw).getbbox() if imageBoxA else None
             if imageBoxA is None or imageBoxB is None:
                 surfaceB, surfaceW = 0, 0
                 diff = 0
@@ -284,7 +290,7 @@ class ComicPage:
                             output_jpeg_file.write(output_jpeg_bytes)
                 else:
                     self.image.save(self.targetPath, 'JPEG', optimize=1, quality=85)
-            return [md5Checksum(self.targetPath), flags, self.orgPath]
+            return [self.targetPath, frozenset(flags), self.orgPath, self.image.size]
         except IOError as err:
             raise RuntimeError('Cannot save image. ' + str(err))
 
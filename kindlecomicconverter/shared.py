@@ -19,15 +19,29 @@
 #
 
 import os
+import sys
+from errno import ENOSPC
 from hashlib import md5
 from html.parser import HTMLParser
+from io import StringIO
 from distutils.version import StrictVersion
-from re import split
+from re import compile
+from struct import unpack, error as StructError
 from traceback import format_tb
 from stat import S_IWRITE, S_IREAD, S_IEXEC
-from shutil import rmtree, copytree
+from shutil import rmtree, copytree, copy2, copystat
 from psutil import disk_usage
 from tempfile import mkdtemp, gettempdir
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from hashlib import file_digest
+except ImportError:
+    file_digest = None
+# FICLONE is a Linux request number, other platforms always copy
+if sys.platform.startswith('linux'):
+    from fcntl import ioctl
+else:
+    ioctl = None
 from . import comicarchive
 from . import pdfjpgextract
 
@@ -38,39 +52,114 @@ class HTMLStripper(HTMLParser):
         self.reset()
         self.strict = False
         self.convert_charrefs = True
-        self.fed = []
+        self.fed = StringIO()
 
     def handle_data(self, d):
-        self.fed.append(d)
+        self.fed.write(d)
 
     def get_data(self):
-        return ''.join(self.fed)
+        return self.fed.getvalue()
 
     def error(self, message):
         pass
 
 
+imageExtensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+
 def getImageFileName(imgfile):
     name, ext = os.path.splitext(imgfile)
     ext = ext.lower()
-    if (name.startswith('.') and len(name) == 1) or ext not in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
+    if (name.startswith('.') and len(name) == 1) or ext not in imageExtensions:
         return None
     return [name, ext]
 
 
+def getImageSize(fpath):
+    # Read dimensions from image header without initializing a decoder
+    with open(fpath, 'rb') as fh:
+        head = fh.read(30)
+        try:
+            if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                return unpack('>II', head[16:24])
+            elif head[:6] in (b'GIF87a', b'GIF89a'):
+                return unpack('<HH', head[6:10])
+            elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                if head[12:16] == b'VP8X':
+                    return (1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little'))
+                elif head[12:16] == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+                    width, height = unpack('<HH', head[26:30])
+                    return width & 0x3FFF, height & 0x3FFF
+                elif head[12:16] == b'VP8L' and head[20] == 0x2F:
+                    bits = unpack('<I', head[21:25])[0]
+                    return 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF)
+            elif head[:2] == b'\xff\xd8':
+                fh.seek(2)
+                while fh.read(1) == b'\xff':
+                    marker = fh.read(1)
+                    while marker == b'\xff':
+                        marker = fh.read(1)
+                    if not marker:
+                        break
+                    marker = marker[0]
+                    if 0xD0 <= marker <= 0xD8 or marker == 0x01:
+                        continue
+                    length = unpack('>H', fh.read(2))[0]
+                    if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                        height, width = unpack('>xHH', fh.read(5))
+                        return width, height
+                    fh.seek(length - 2, 1)
+        except (StructError, IndexError):
+            pass
+    from PIL import Image
+    with Image.open(fpath) as img:
+        return img.size
+
+
+# Threads for size and permission syscalls, they mostly wait on slow network storage
+ioWorkers = 32
+# Below this many files a thread pool costs more than the stat calls it spreads out
+ioPoolThreshold = 1000
+
+
 def getDirectorySize(start_path='.'):
-    total_size = 0
-    for dirpath, _, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
+    files = [entry for entry in walkFiles(start_path) if not entry.is_dir()]
+    if len(files) < ioPoolThreshold:
+        return sum(entry.stat().st_size for entry in files)
+    with ThreadPoolExecutor(max_workers=ioWorkers) as executor:
+        return sum(executor.map(lambda entry: entry.stat().st_size, files))
+
+
+# FICLONE from linux/fs.h
+cloneRequest = 0x40049409
+
+
+def cloneFile(src, dst):
+    # Share the data blocks on reflink capable filesystems, fall back to a regular copy otherwise
+    if ioctl:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                ioctl(fdst.fileno(), cloneRequest, fsrc.fileno())
+            copystat(src, dst)
+            return dst
+        except OSError:
+            # dst is left truncated, copy2 overwrites it
+            pass
+    return copy2(src, dst)
+
+
+def cloneWorkFile(src, dst):
+    # copytree only collects OSError, so a full disk stops the copy at the first failed file
+    try:
+        return cloneFile(src, dst)
+    except OSError as err:
+        if err.errno == ENOSPC:
+            raise UserWarning("Not enough disk space to perform conversion.")
+        raise
 
 
 def getWorkFolder(afile, name, ebook=True):
     if os.path.isdir(afile):
-        if disk_usage(gettempdir())[2] < getDirectorySize(afile) * 2.5:
-            raise UserWarning("Not enough disk space to perform conversion.")
         workdir = mkdtemp('', name)
         try:
             os.rmdir(workdir)
@@ -78,46 +167,59 @@ def getWorkFolder(afile, name, ebook=True):
                 fullPath = os.path.join(workdir, 'OEBPS', 'Images')
             else:
                 fullPath = workdir
-            copytree(afile, fullPath)
+            copytree(afile, fullPath, copy_function=cloneWorkFile)
             sanitizePermissions(fullPath)
             return os.path.abspath(workdir)
-        except Exception:
+        except UserWarning:
+            rmtree(workdir, True)
+            raise
+        except Exception as err:
             rmtree(workdir, True)
+            if isinstance(err, OSError) and err.errno == ENOSPC:
+                raise UserWarning("Not enough disk space to perform conversion.")
             raise UserWarning("Failed to prepare a workspace.")
     elif os.path.isfile(afile):
         if disk_usage(gettempdir())[2] < os.path.getsize(afile) * 2.5:
             raise UserWarning("Not enough disk space to perform conversion.")
+        workdir = mkdtemp('', name)
+        if ebook:
+            fullPath = os.path.join(workdir, 'OEBPS', 'Images')
+        else:
+            fullPath = workdir
         if str(afile).lower().endswith('.pdf'):
             pdf = pdfjpgextract.PdfJpgExtract(afile)
             path, njpg = pdf.extract()
             if njpg == 0:
                 rmtree(path, True)
+                rmtree(workdir, True)
                 raise UserWarning("Failed to extract images from PDF file.")
+            copytree(path, fullPath, copy_function=cloneFile, dirs_exist_ok=True)
+            rmtree(path, True)
         else:
-            workdir = mkdtemp('', name)
             try:
+                os.makedirs(fullPath, exist_ok=True)
                 cbx = comicarchive.ComicArchive(afile)
-                path = cbx.extract(workdir)
+                cbx.extract(fullPath)
             except OSError as e:
                 rmtree(workdir, True)
                 raise UserWarning(e.strerror)
-        sanitizePermissions(path)
-        newpath = mkdtemp('', name)
-        if ebook:
-            copytree(path, os.path.join(newpath, 'OEBPS', 'Images'))
-        else:
-            copytree(path, workdir)
-        rmtree(path, True)
-        return os.path.abspath(newpath)
+        sanitizePermissions(fullPath)
+        return os.path.abspath(workdir)
     else:
         raise UserWarning("Failed to open source file/directory.")
 
 
+walkSortPattern = compile('([0-9]+)')
+
+
+def walkSortKey(name):
+    # Names equal apart from case fall back to a plain comparison instead of listing order
+    return [int(c) if c.isdigit() else c for c in walkSortPattern.split(name.lower())], name
+
+
 def walkSort(dirnames, filenames):
-    convert = lambda text: int(text) if text.isdigit() else text
-    alphanum_key = lambda key: [convert(c) for c in split('([0-9]+)', key)]
-    dirnames.sort(key=lambda name: alphanum_key(name.lower()))
-    filenames.sort(key=lambda name: alphanum_key(name.lower()))
+    dirnames.sort(key=walkSortKey)
+    filenames.sort(key=walkSortKey)
     return dirnames, filenames
 
 
@@ -133,14 +235,28 @@ def walkLevel(some_dir, level=1):
             del dirs[:]
 
 
+def walkFiles(some_dir):
+    with os.scandir(some_dir) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walkFiles(entry.path)
+        else:
+            yield entry
+
+
 def md5Checksum(fpath):
     with open(fpath, 'rb') as fh:
+        if file_digest:
+            return file_digest(fh, 'md5').hexdigest()
         m = md5()
+        buf = bytearray(1 << 20)
+        view = memoryview(buf)
         while True:
-            data = fh.read(8192)
-            if not data:
+            size = fh.readinto(buf)
+            if not size:
                 break
-            m.update(data)
+            m.update(view[:size])
         return m.hexdigest()
 
 
@@ -157,11 +273,29 @@ def sanitizeTrace(traceback):
 
 
 def sanitizePermissions(filetree):
-    for root, dirs, files in os.walk(filetree, False):
-        for name in files:
-            os.chmod(os.path.join(root, name), S_IWRITE | S_IREAD)
-        for name in dirs:
-            os.chmod(os.path.join(root, name), S_IWRITE | S_IREAD | S_IEXEC)
+    with ThreadPoolExecutor(max_workers=ioWorkers) as executor:
+        sanitizeDirectoryPermissions(filetree, executor)
+
+
+def sanitizeDirectoryPermissions(path, executor):
+    with os.scandir(path) as it:
+        entries = list(it)
+    items = []
+    for entry in entries:
+        if entry.is_dir():
+            if not entry.is_symlink():
+                sanitizeDirectoryPermissions(entry.path, executor)
+            items.append((entry, S_IWRITE | S_IREAD | S_IEXEC))
+        else:
+            items.append((entry, S_IWRITE | S_IREAD))
+    if os.chmod in os.supports_dir_fd:
+        dirFd = os.open(path, os.O_RDONLY)
+        try:
+            list(executor.map(lambda item: os.chmod(item[0].name, item[1], dir_fd=dirFd), items))
+        finally:
+            os.close(dirFd)
+    else:
+        list(executor.map(lambda item: os.chmod(item[0].path, item[1]), items))
 
 
 # noinspection PyUnresolvedReferences
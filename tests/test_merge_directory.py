@@ -0,0 +1,30 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from kindlecomicconverter import comic2panel
+
+
+class MergeDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def test_upscaled_page_overflow(self):
+        # The narrow page is upscaled to 100x2000, past the 1910px strip
+        for name, size in [('a.jpg', (50, 1000)), ('b.jpg', (100, 10)), ('c.jpg', (100, 900))]:
+            Image.new('RGB', size, 'white').save(os.path.join(self.workdir, name))
+        self.assertIsNone(comic2panel.mergeDirectory([self.workdir]))
+        files = os.listdir(self.workdir)
+        self.assertEqual(len(files), 1, files)
+        with Image.open(os.path.join(self.workdir, files[0])) as merged:
+            self.assertEqual(merged.size, (100, 1910))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from kindlecomicconverter import comic2ebook
+from kindlecomicconverter.comic2ebook import slugify
+from kindlecomicconverter.shared import walkSort
+
+
+# Two pass implementation sanitizeTree replaced, kept as the behavior reference
+def referenceSanitizeTree(filetree):
+    chapterNames = {}
+    for root, dirs, files in os.walk(filetree, False):
+        for name in files:
+            if not name == "ComicInfo.xml":
+                splitname = os.path.splitext(name)
+                slugified = slugify(splitname[0], False)
+                while os.path.exists(os.path.join(root, slugified + splitname[1])) and splitname[0].upper()\
+                        != slugified.upper():
+                    slugified += "A"
+                newKey = os.path.join(root, slugified + splitname[1])
+                key = os.path.join(root, name)
+                if key != newKey:
+                    os.replace(key, newKey)
+        for name in dirs:
+            tmpName = name
+            slugified = slugify(name, True)
+            while os.path.exists(os.path.join(root, slugified)) and name.upper() != slugified.upper():
+                slugified += "A"
+            chapterNames[slugified] = tmpName
+            newKey = os.path.join(root, slugified)
+            key = os.path.join(root, name)
+            if key != newKey:
+                os.replace(key, newKey)
+    return chapterNames
+
+
+def referenceSanitizeTreeKobo(filetree):
+    pageNumber = 0
+    for root, dirs, files in os.walk(filetree):
+        dirs, files = walkSort(dirs, files)
+        for name in files:
+            if not name == "ComicInfo.xml":
+                splitname = os.path.splitext(name)
+                slugified = str(pageNumber).zfill(5)
+                pageNumber += 1
+                while os.path.exists(os.path.join(root, slugified + splitname[1])) and splitname[0].upper()\
+                        != slugified.upper():
+                    slugified += "A"
+                newKey = os.path.join(root, slugified + splitname[1])
+                key = os.path.join(root, name)
+                if key != newKey:
+                    os.replace(key, newKey)
+
+
+def existsIgnoreCase(path, exists=os.path.exists):
+    # Simulates the default NTFS/APFS lookup, the real file system here is case-sensitive
+    directory, name = os.path.split(path)
+    if not exists(directory):
+        return False
+    return name.casefold() in set(entry.casefold() for entry in os.listdir(directory))
+
+
+def makeTree(root, rng, depth=0):
+    # Names that slugify to the same value, plus ones differing only by case
+    fileNames = ['Page 1.jpg', 'page-1.jpg', 'PAGE_01.jpg', 'page 01.jpg', 'Page-0001.jpg', 'page-0001.JPG',
+                 '00001.jpg', '00002.png', 'p2.png', 'P2.png', 'ComicInfo.xml']
+    dirNames = ['ch 1', 'Ch 1', 'ch-1', 'CH_01', 'ch 01', 'ch-0001', 'Chapter 2', 'chapter-2']
+    for name in rng.sample(fileNames, rng.randint(0, 6)):
+        with open(os.path.join(root, name), 'w') as f:
+            f.write(name)
+    if depth < 2:
+        for name in rng.sample(dirNames, rng.randint(0, 3)):
+            os.mkdir(os.path.join(root, name))
+            makeTree(os.path.join(root, name), rng, depth + 1)
+
+
+def readTree(root):
+    tree = {}
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(dirpath, name)) as f:
+                tree[os.path.relpath(os.path.join(dirpath, name), root)] = f.read()
+    return tree
+
+
+class SanitizeTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(comic2ebook, 'options', SimpleNamespace(imgMetadata={}, imgSize={}), create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def compareTrees(self, kobo):
+        for seed in range(200):
+            rng = random.Random(seed)
+            source = os.path.join(self.workdir, str(seed))
+            os.mkdir(source)
+            makeTree(source, rng)
+            expected = source + '-expected'
+            shutil.copytree(source, expected)
+            expectedNames = referenceSanitizeTree(expected)
+            if kobo:
+                referenceSanitizeTreeKobo(expected)
+            chapterNames = comic2ebook.sanitizeTree(source, kobo)
+            self.assertEqual(chapterNames, expectedNames, seed)
+            self.assertEqual(readTree(source), readTree(expected), seed)
+
+    def test_matches_reference(self):
+        self.compareTrees(False)
+
+    def test_matches_reference_kobo(self):
+        self.compareTrees(True)
+
+    def test_case_insensitive_collision(self):
+        for name in ['page 0001.jpg', 'PAGE-0001.jpg']:
+            with open(os.path.join(self.workdir, name), 'w') as f:
+                f.write(name)
+        os.mkdir(os.path.join(self.workdir, 'ch 1'))
+        os.mkdir(os.path.join(self.workdir, 'CH-1'))
+        with mock.patch('os.path.exists', existsIgnoreCase):
+            chapterNames = comic2ebook.sanitizeTree(self.workdir)
+        names = os.listdir(self.workdir)
+        self.assertEqual(len(set(name.casefold() for name in names)), 4, names)
+        self.assertEqual(sorted(readTree(self.workdir).values()), ['PAGE-0001.jpg', 'page 0001.jpg'])
+        self.assertEqual(sorted(chapterNames.values()), ['CH-1', 'ch 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()